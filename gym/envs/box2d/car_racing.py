@@ -11,6 +11,7 @@ import numpy as np
 from Box2D import b2Vec2
 from Box2D.b2 import (edgeShape, circleShape, fixtureDef, polygonShape, revoluteJointDef, contactListener)
 from PIL import Image
+from scipy.spatial.distance import cdist
 
 import gym
 from gym import spaces
@@ -20,6 +21,21 @@ from gym.utils import colorize, seeding, EzPickle
 import pyglet
 from pyglet import gl
 
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional, without it the jitted helpers run as plain python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda fn: fn
+
+try:
+    import simsimd
+except ImportError:
+    # simsimd is optional, without it the distances come from scipy
+    simsimd = None
+
 # Easiest continuous control task to learn from pixels, a top-down racing environment.
 # Discreet control is reasonable in this environment as well, on/off discretisation is
 # fine.
@@ -62,6 +78,7 @@ ZOOM        = 2.7        # Camera zoom, 0.25 to take screenshots, default 2.7
 ZOOM_FOLLOW = True       # Set to False for fixed view (don't use zoom)
 
 TRACK_DETAIL_STEP = 21/SCALE
+TRACK_DETAIL_STEP_SQ = TRACK_DETAIL_STEP**2
 TRACK_TURN_RATE = 0.31
 TRACK_WIDTH = 40/SCALE
 BORDER = 8/SCALE
@@ -102,6 +119,15 @@ SHOW_BETA_PI_ANGLE        = 0       # Shows the direction of the beta+pi/2 angle
 # in the behaviour of the game and you will not realise 
 FORBID_HARD_TURNS_IN_INTERSECTIONS = False 
 
+# Layout of the bars of the indicators in units of W/40 (x) and H/40 (y),
+# the vertical bars are the speed and the ABS sensors and the horizontal
+# ones the steering and the angular velocity
+INDICATORS_VERTICAL_X  = np.arange(21, 26)[:,None] + np.array([0,1,1,0])
+INDICATORS_VERTICAL_UP = np.array([1,1,0,0])
+INDICATORS_HORIZ_X     = np.array([30, 36])[:,None]
+INDICATORS_HORIZ_SIDE  = np.array([0,1,1,0])
+INDICATORS_HORIZ_Y     = np.array([4,4,2,2])
+
 def key_press_example(k, mod):
     """
     Example callback function
@@ -118,6 +144,116 @@ def key_release_example(k, mod):
         # change a value or print something
         pass
 
+@njit(cache=True)
+def _walk_track(checkpoints, x, y, beta, no_freeze):
+    '''
+    Goes from one checkpoint to another to create the track, starting
+    at (x,y) with angle beta. checkpoints is a (N,3) array [alpha,x,y].
+    Returns a (no_freeze,4) array [alpha,beta,x,y] and the number of
+    rows of it that were filled
+    '''
+    track = np.empty((no_freeze, 4))
+    num_checkpoints = checkpoints.shape[0]
+    dest_i = 0
+    laps = 0
+    n = 0
+    visited_other_side = False
+    while n < no_freeze:
+        alpha = math.atan2(y, x)
+        if visited_other_side and alpha > 0:
+            laps += 1
+            visited_other_side = False
+        if alpha < 0:
+            visited_other_side = True
+            alpha += 2*math.pi
+        while True: # Find destination from checkpoints
+            failed = True
+            while True:
+                if alpha <= checkpoints[dest_i % num_checkpoints,0]:
+                    failed = False
+                    break
+                dest_i += 1
+                if dest_i % num_checkpoints == 0: break
+            if not failed: break
+            alpha -= 2*math.pi
+        dest_x = checkpoints[dest_i % num_checkpoints,1]
+        dest_y = checkpoints[dest_i % num_checkpoints,2]
+        r1x = math.cos(beta)
+        r1y = math.sin(beta)
+        p1x = -r1y
+        p1y = r1x
+        dest_dx = dest_x - x  # vector towards destination
+        dest_dy = dest_y - y
+        proj = r1x*dest_dx + r1y*dest_dy  # destination vector projected on rad
+        # Makes |beta - alpha| <= pi
+        beta -= 2*math.pi*round((beta - alpha)/(2*math.pi))
+        prev_beta = beta
+        proj *= SCALE
+        if proj >  0.3: beta -= min(TRACK_TURN_RATE, abs(0.001*proj))
+        if proj < -0.3: beta += min(TRACK_TURN_RATE, abs(0.001*proj))
+        x += p1x*TRACK_DETAIL_STEP
+        y += p1y*TRACK_DETAIL_STEP
+        track[n,0] = alpha
+        track[n,1] = prev_beta*0.5 + beta*0.5
+        track[n,2] = x
+        track[n,3] = y
+        n += 1
+        if laps > 4: break
+    return track, n
+
+@njit(cache=True)
+def _find_section(track_pts, first, last, thresh2):
+    '''
+    Looks in track_pts, the (N,2,2) [x,y] points of the tiles of a track,
+    for the section that goes from the first tile closer than sqrt(thresh2)
+    to first until the next tile closer than sqrt(thresh2) to last.
+    Returns the start and end (not included) positions of the section,
+    positions can go up to 2N because the section can go around the track,
+    start is -1 if there is no tile close to first
+    '''
+    n = track_pts.shape[0]
+    start = -1
+    for pos in range(2*n):
+        x = track_pts[pos % n,1,0]
+        y = track_pts[pos % n,1,1]
+        if start == -1:
+            dx = x - first[0]
+            dy = y - first[1]
+            if dx*dx + dy*dy <= thresh2:
+                start = pos
+        if start != -1:
+            dx = x - last[0]
+            dy = y - last[1]
+            if dx*dx + dy*dy <= thresh2:
+                return start, pos+1
+    return start, 2*n
+
+def _sq_distances(a, b):
+    '''
+    Squared euclidean distances between the (N,2) points of a and the (M,2)
+    points of b, shape (N,M)
+    '''
+    if simsimd is not None:
+        return np.asarray(simsimd.cdist(
+            np.ascontiguousarray(a), np.ascontiguousarray(b), metric='sqeuclidean'))
+    return cdist(a, b, 'sqeuclidean')
+
+@njit(cache=True)
+def _prune_tiles(track_pts, sec_pts):
+    '''
+    Returns the keep-mask of the tiles in track_pts, the (N,2,2) [x,y]
+    points of the tiles of a track, that are not in sec_pts (M,2,2)
+    '''
+    n = track_pts.shape[0]
+    keep = np.ones(n, dtype=np.bool_)
+    for i in range(n):
+        for j in range(sec_pts.shape[0]):
+            if track_pts[i,0,0] == sec_pts[j,0,0] and track_pts[i,0,1] == sec_pts[j,0,1] and \
+                    track_pts[i,1,0] == sec_pts[j,1,0] and track_pts[i,1,1] == sec_pts[j,1,1]:
+                keep[i] = False
+                break
+    return keep
+
 def original_reward_callback(env):
     reward,done = -0.1,False
 
@@ -128,7 +264,7 @@ def original_reward_callback(env):
     visited_count = env.info['visited'].sum()
 
     count = ( (left | right) & not_visited).sum()
-    reward += 1000/len(env.track) * count
+    reward += env._reward_per_tile * count
 
     env.info['visited'][left | right] = True
     env.info['count_right_delay'] = env.info['count_right']
@@ -222,28 +358,30 @@ class FrictionDetector(contactListener):
     def EndContact(self, contact):
         self._contact(contact, False)
     def _contact(self, contact, begin):
-        tile = None
-        obj = None
-        u1 = contact.fixtureA.body.userData
-        u2 = contact.fixtureB.body.userData
-        if u1 and "road_friction" in u1.__dict__:
-            tile = u1
-            obj  = u2
-        if u2 and "road_friction" in u2.__dict__:
-            tile = u2
-            obj  = u1
-        if not tile: return
+        f1 = contact.fixtureA
+        f2 = contact.fixtureB
+        # Tiles and obstacles are the fixtures with road_friction in its
+        # userData, obj is the body touching them, f2 has priority
+        if getattr(f2.userData, "road_friction", None) is not None:
+            tile = f2.userData
+            obj  = f1.body.userData
+        elif getattr(f1.userData, "road_friction", None) is not None:
+            tile = f1.userData
+            obj  = f2.body.userData
+        else:
+            return
 
         if tile.typename != OBSTACLE_NAME:
             tile.color[0] = ROAD_COLOR[0]
             tile.color[1] = ROAD_COLOR[1]
             tile.color[2] = ROAD_COLOR[2]
-        if not obj or "tiles" not in obj.__dict__: return
+        obj_tiles = getattr(obj, "tiles", None)
+        if obj_tiles is None: return
 
         if begin:
             if tile.typename == TILE_NAME:
                 self.env.add_current_tile(tile.id, tile.lane)
-                obj.tiles.add(tile)
+                obj_tiles.add(tile)
 
                 #self.env.reward_tiles.add(tile)
                 if tile.lane == 1:
@@ -258,7 +396,7 @@ class FrictionDetector(contactListener):
                 self.env.obstacle_contacts['count_delay'][tile.id] += 1
         else:
             if tile.typename == TILE_NAME:
-                obj.tiles.remove(tile)
+                obj_tiles.remove(tile)
                 self.env.remove_current_tile(tile.id, tile.lane)
 
                 if tile.lane == 1:
@@ -379,6 +517,16 @@ class CarRacing(gym.Env, EzPickle):
         EzPickle.__init__(self)
         self.seed()
         self.viewer = None
+        self._pixels_buffers = {} # (width,height) -> buffer where the frames are read
+        self._grid_batch = None # checkerboard of the grass, it never changes
+        self._indicators_batch = None
+        # scratch of render_indicators, filled in place every frame
+        self._indicators_vals  = np.empty(7)
+        self._indicators_verts = np.empty((8,4,2))
+        # quads drawn together by _draw_quads, the buffers grow when needed
+        self._quads_verts  = np.empty((64,4,2))
+        self._quads_colors = np.empty((64,4))
+        self._quads_count  = 0
         self.invisible_state_window = None
         self.invisible_video_window = None
         self.road = None
@@ -569,17 +717,17 @@ class CarRacing(gym.Env, EzPickle):
     def update_contact_with_track(self):
         self.last_touch_with_track = self.t
 
-    def set_velocity(self, velocity=[0.0,0.0]):
-        self.car.hull.linearVelocity.Set(velocity[0],velocity[1])
+    def set_velocity(self, vx=0.0, vy=0.0):
+        velocity = (vx, vy)
+        omega = math.hypot(vx, vy)
+        self.car.hull.linearVelocity = velocity
         for w in self.car.wheels:
             w.linearVelocity = velocity
-            w.omega = np.linalg.norm(velocity)
+            w.omega = omega
 
     def set_speed(self, speed):
         ang = self.car.hull.angle + math.pi/2
-        velocity_x = math.cos(ang)*speed
-        velocity_y = math.sin(ang)*speed
-        self.set_velocity([velocity_x, velocity_y])
+        self.set_velocity(math.cos(ang)*speed, math.sin(ang)*speed)
 
     def seed(self, seed=None):
         self.np_random, seed = seeding.np_random(seed)
@@ -789,7 +937,7 @@ class CarRacing(gym.Env, EzPickle):
         intersection = {'left':None,'right':None,'straight':None}
         relative_id = self._to_relative(node_id)
         track_id = self.info[node_id]['track']
-        _,angle_org,x,y = self.track[node_id][1]
+        _,angle_org,x,y = self.track[node_id,1]
         
         angle = (angle_org + direction*np.pi/2)%(np.pi*2)
         
@@ -883,71 +1031,22 @@ class CarRacing(gym.Env, EzPickle):
 
         #num_checkpoints = 12
 
-        # Create checkpoints
-        checkpoints = []
-        for c in range(num_checkpoints):
-            alpha = 2*math.pi*c/num_checkpoints + self.np_random.uniform(0, 2*math.pi*1/num_checkpoints)
-            rad = self.np_random.uniform(track_rad/3, track_rad)
-            if c==0:
-                alpha = 0
-                rad = 1.5*track_rad
-            if c==num_checkpoints-1:
-                alpha = 2*math.pi*c/num_checkpoints
-                self.start_alpha = 2*math.pi*(-0.5)/num_checkpoints
-                rad = 1.5*track_rad
-            checkpoints.append( (alpha, rad*math.cos(alpha), rad*math.sin(alpha)) )
+        # Create checkpoints, all of them at once, shape (num_checkpoints,3) [alpha,x,y]
+        alphas = 2*np.pi*np.arange(num_checkpoints)/num_checkpoints + \
+                self.np_random.uniform(0, 2*np.pi/num_checkpoints, size=num_checkpoints)
+        rads = self.np_random.uniform(track_rad/3, track_rad, size=num_checkpoints)
+        alphas[0]  = 0
+        rads[0]    = 1.5*track_rad
+        alphas[-1] = 2*np.pi*(num_checkpoints-1)/num_checkpoints
+        rads[-1]   = 1.5*track_rad
+        self.start_alpha = 2*math.pi*(-0.5)/num_checkpoints
+        checkpoints = np.stack([alphas, rads*np.cos(alphas), rads*np.sin(alphas)], axis=1)
 
         #print "\n".join(str(h) for h in checkpoints)
-        #self.road_poly = [ (    # uncomment this to see checkpoints
-        #    [ (tx,ty) for a,tx,ty in checkpoints ],
-        #    (0.7,0.7,0.9) ) ]
 
         # Go from one checkpoint to another to create track
-        x, y, beta = 1.5*track_rad, 0, 0
-        dest_i = 0
-        laps = 0
-        track = []
-        no_freeze = 2500
-        visited_other_side = False
-        while 1:
-            alpha = math.atan2(y, x)
-            if visited_other_side and alpha > 0:
-                laps += 1
-                visited_other_side = False
-            if alpha < 0:
-                visited_other_side = True
-                alpha += 2*math.pi
-            while True: # Find destination from checkpoints
-                failed = True
-                while True:
-                    dest_alpha, dest_x, dest_y = checkpoints[dest_i % len(checkpoints)]
-                    if alpha <= dest_alpha:
-                        failed = False
-                        break
-                    dest_i += 1
-                    if dest_i % len(checkpoints) == 0: break
-                if not failed: break
-                alpha -= 2*math.pi
-                continue
-            r1x = math.cos(beta)
-            r1y = math.sin(beta)
-            p1x = -r1y
-            p1y = r1x
-            dest_dx = dest_x - x  # vector towards destination
-            dest_dy = dest_y - y
-            proj = r1x*dest_dx + r1y*dest_dy  # destination vector projected on rad
-            while beta - alpha >  1.5*math.pi: beta -= 2*math.pi
-            while beta - alpha < -1.5*math.pi: beta += 2*math.pi
-            prev_beta = beta
-            proj *= SCALE
-            if proj >  0.3: beta -= min(TRACK_TURN_RATE, abs(0.001*proj))
-            if proj < -0.3: beta += min(TRACK_TURN_RATE, abs(0.001*proj))
-            x += p1x*TRACK_DETAIL_STEP
-            y += p1y*TRACK_DETAIL_STEP
-            track.append( (alpha,prev_beta*0.5 + beta*0.5,x,y) )
-            if laps > 4: break
-            no_freeze -= 1
-            if no_freeze==0: break
+        track, n = _walk_track(checkpoints, 1.5*track_rad, 0.0, 0.0, 2500)
+        track = track[:n]
         #print "\n".join([str(t) for t in enumerate(track)])
 
         # Find closed loop range i1..i2, first loop should be ignored, second is OK
@@ -956,7 +1055,7 @@ class CarRacing(gym.Env, EzPickle):
         while True:
             i -= 1
             if i==0: return False  # Failed
-            pass_through_start = track[i][0] > self.start_alpha and track[i-1][0] <= self.start_alpha
+            pass_through_start = track[i,0] > self.start_alpha and track[i-1,0] <= self.start_alpha
             if pass_through_start and i2==-1:
                 i2 = i
             elif pass_through_start and i1==-1:
@@ -969,19 +1068,22 @@ class CarRacing(gym.Env, EzPickle):
 
         track = track[i1:i2-1]
 
-        first_beta = track[0][1]
+        first_beta = track[0,1]
         first_perp_x = math.cos(first_beta)
         first_perp_y = math.sin(first_beta)
-        # Length of perpendicular jump to put together head and tail
-        well_glued_together = np.sqrt(
-            np.square( first_perp_x*(track[0][2] - track[-1][2]) ) +
-            np.square( first_perp_y*(track[0][3] - track[-1][3]) ))
-        if well_glued_together > TRACK_DETAIL_STEP:
+        # Length of perpendicular jump to put together head and tail (squared)
+        dx = first_perp_x*(track[0,2] - track[-1,2])
+        dy = first_perp_y*(track[0,3] - track[-1,3])
+        if dx*dx + dy*dy > TRACK_DETAIL_STEP_SQ:
             return False
 
-        track = [[a,b,x+x_bias*2,y+y_bias*2] for a,b,x,y in track]
-        track = [[track[i-1],track[i]] for i in range(len(track))]
-        return track
+        track = track + (0, 0, x_bias*2, y_bias*2)
+
+        # Each tile goes from the previous point (index 0) to the current one (index 1)
+        pairs = np.empty((len(track),2,4))
+        pairs[:,1] = track
+        pairs[:,0] = np.roll(track, 1, axis=0)
+        return pairs
 
     def _get_possible_candidates_for_obstacles(self):
         return list(range(len(self.track)))
@@ -1075,9 +1177,9 @@ class CarRacing(gym.Env, EzPickle):
 
             # Add it to obstacles
             # Add it to poly_obstacles
-            t = self.world.CreateStaticBody( fixtures = fixtureDef(
-                shape=polygonShape(vertices=vertices)
-                ))
+            self.fd_tile.shape.vertices = vertices
+            body = self.world.CreateStaticBody(fixtures=self.fd_tile)
+            t = body.fixtures[0]
             t.userData = t
             t.color = [0.86,0.08,0.23] 
             #c = 0.01*(count%3)
@@ -1088,18 +1190,16 @@ class CarRacing(gym.Env, EzPickle):
             t.road_visited = False
             t.id = count
             t.tile_id = idx
-            t.fixtures[0].sensor = True
+            t.sensor = True
             self.obstacles_poly.append(( vertices, t.color ))
-            self.road.append(t)
+            self.road.append(body)
             self.info[idx]['obstacles'] = True
 
-    def _create_info(self):
+    def _info_dtype(self):
         '''
-        Creates the matrix with the information about the track points,
-        whether they are at the end of the track, if they are intersections
+        The dtype of the matrix with the information about the track points
         '''
-        # Get if point is at the end
-        info  = np.zeros((sum(len(t) for t in self.tracks)),dtype=[
+        return [
             ('track', 'int'),
             ('end','bool'),
             ('begining', 'bool'),
@@ -1111,21 +1211,48 @@ class CarRacing(gym.Env, EzPickle):
             ('used','bool'),
             ('angle', 'float16'),
             ('ang_class','float16'),
-            ('lanes',np.ndarray),
+            ('lanes',np.bool_,(self.num_lanes,)),
             ('count_left', 'int'),
             ('count_right', 'int'),
             ('count_left_delay', 'int'),
             ('count_right_delay', 'int'),
             ('visited',bool),
             #('obstacles',np.ndarray)])
-            ('obstacles',bool)])
+            ('obstacles',bool)]
 
+    def _upgrade_info(self, old):
+        '''
+        Returns the info loaded from a file with the dtype of _create_info,
+        files saved before 'lanes' was a bool field keep the lanes of each
+        tile as an object field with lists ([True, True] when there is
+        a single lane)
+        '''
+        info = np.zeros(len(old), dtype=self._info_dtype())
         info['ang_class'] = np.nan
         info['intersection_id'] = -1
-        info['obstacles'] = False
+        info['lanes'] = True
+        for name in info.dtype.names:
+            if name != 'lanes' and name in old.dtype.names:
+                info[name] = old[name]
+        if 'lanes' in old.dtype.names:
+            lanes = old['lanes']
+            if lanes.dtype == object:
+                lanes = np.array(lanes.tolist(), dtype=bool)
+            info['lanes'] = lanes.reshape(len(old), -1)[:,:self.num_lanes]
+        return info
 
-        for i in range(len(info)):
-            info[i]['lanes'] = [True, True]
+    def _create_info(self):
+        '''
+        Creates the matrix with the information about the track points,
+        whether they are at the end of the track, if they are intersections
+        '''
+        # Get if point is at the end
+        info  = np.zeros((sum(len(t) for t in self.tracks)),dtype=self._info_dtype())
+
+        info['ang_class'] = np.nan
+        info['intersection_id'] = -1
+        info['obstacles'] = False
+        info['lanes'] = True
 
         for i in range(1, len(self.tracks)): 
             track = self.tracks[i]
@@ -1306,13 +1433,18 @@ class CarRacing(gym.Env, EzPickle):
             if len(changes_bad) > 0:
                 changes = np.setdiff1d(changes,changes_bad)
 
+            # The lane removed at each change, drawn at once from the seeded rng
+            changes_lanes = self.np_random.randint(0,2,len(changes))
+
             counter = 0 # in order to avoid more than max number of single lanes tiles
+            n_change = 0
             for i, point in enumerate(self.track):
                 change = True if i in changes else False
                 rm_lane = (rm_lane+change)%2
 
                 if change and rm_lane == 1: # if it is time to change and the turn is to remove lane
-                    lane = np.random.randint(0,2,1)[0]
+                    lane = changes_lanes[n_change]
+                n_change += change
 
                 if rm_lane:
                     self.info[i]['lanes'][lane] = False
@@ -1326,11 +1458,12 @@ class CarRacing(gym.Env, EzPickle):
 
             # Avoiding any change of lanes in last and beginning part of a track
             for num_track in range(self.num_tracks):
+                track_idxs = np.where(self.info['track'] == num_track)[0]
                 for lane in range(self.num_lanes):
                     for i in range(10):
                         i %= len(self.tracks[num_track])
-                        self.info[self.info['track'] == num_track][+i]['lanes'][lane] = True
-                        self.info[self.info['track'] == num_track][-i]['lanes'][lane] = True
+                        self.info['lanes'][track_idxs[+i],lane] = True
+                        self.info['lanes'][track_idxs[-i],lane] = True
 
     def _remove_unfinished_roads(self):
         n = 0
@@ -1368,7 +1501,7 @@ class CarRacing(gym.Env, EzPickle):
             else:
                 self.track  = dic['track']
                 self.tracks = dic['tracks']
-                self.info   = dic['info']
+                self.info   = self._upgrade_info(dic['info'])
                 self.obstacle_contacts = np.zeros((len(self.obstacles_poly)),dtype=
                         [('count',int),('count_delay',int),('visited',bool)])
 
@@ -1387,8 +1520,7 @@ class CarRacing(gym.Env, EzPickle):
                 # The following variables allow for more complex tracks but, it is also 
                 # harder to controll their properties and correct behaviour
                 track = self._get_track(int(cp*(1**_)))#,x_bias=-40*_,y_bias=40*_)
-                if not track or len(track) == 0: return track
-                track = np.array(track)
+                if track is False or len(track) == 0: return False
                 if _ > 0 and False:
                     # adding rotation to decrease number of overlaps
                     theta = np.random.uniform()*2*np.pi
@@ -1421,32 +1553,73 @@ class CarRacing(gym.Env, EzPickle):
 
             self._set_lanes()
         
+    def _init_road_poly(self, size):
+        '''
+        Allocates the buffers of the road polygons, size is the max
+        number of polygons that can be added to them
+        '''
+        self.road_poly_verts  = np.empty((size,4,2))
+        self.road_poly_colors = np.empty((size,3))
+        self.road_poly_ids    = np.empty(size, dtype=int)
+        self.road_poly_lanes  = np.empty(size, dtype=int)
+        self.road_poly_count  = 0
+        # scratch for the colors drawn with the trail of predicted tiles
+        self._road_poly_trail_colors = np.empty((size,3))
+        # The batch with the tiles is built again the next time they are drawn
+        self._road_batch = None
+
+    @property
+    def road_poly(self):
+        '''
+        List of (vertices, color, id, lane) of each road polygon, vertices
+        and color are views of road_poly_verts and road_poly_colors.
+        Read-only, polygons are added through the road_poly_* buffers
+        allocated by _init_road_poly and road_poly_count
+        '''
+        n = self.road_poly_count
+        return list(zip(
+            self.road_poly_verts[:n],
+            self.road_poly_colors[:n],
+            self.road_poly_ids[:n],
+            self.road_poly_lanes[:n]))
+
     def _create_track(self):
 
         Ok = self._generate_track()
         if Ok is False:
             return False
+
+        # Trigonometry of the angles of all tiles at once, the index 1
+        # is the end of the tile and 0 its beginning
+        cos1 = np.cos(self.track[:,1,1]).tolist()
+        sin1 = np.sin(self.track[:,1,1]).tolist()
+        # kept to place points inside the lanes of a tile
+        self._cos_beta = cos1
+        self._sin_beta = sin1
+        cos2 = np.cos(self.track[:,0,1]).tolist()
+        sin2 = np.sin(self.track[:,0,1]).tolist()
     
         # Red-white border on hard turns
         borders = []
         if False:
             for track in self.tracks:
-                border = [False]*len(track)
-                for i in range(1,len(track)):
-                    good = True
-                    oneside = 0
-                    for neg in range(BORDER_MIN_COUNT):
-                        beta1 = track[i-neg][1][1]
-                        beta2 = track[i-neg][0][1]
-                        good &= abs(beta1 - beta2) > TRACK_TURN_RATE*0.2
-                        oneside += np.sign(beta1 - beta2)
-                    good &= abs(oneside) == BORDER_MIN_COUNT
-                    border[i] = good
-                for i in range(len(track)):
-                    for neg in range(BORDER_MIN_COUNT):
-                        # TODO ERROR, sometimes list index out of range
-                        border[i-neg] |= border[i]
-                borders.append(border)
+                # A tile is a border if it and the BORDER_MIN_COUNT-1 tiles
+                # before it turn hard to the same side
+                dbeta   = track[:,1,1] - track[:,0,1]
+                good    = np.abs(dbeta) > TRACK_TURN_RATE*0.2
+                sign    = np.sign(dbeta)
+                border  = np.ones(len(track), dtype=bool)
+                oneside = np.zeros(len(track))
+                for neg in range(BORDER_MIN_COUNT):
+                    border  &= np.roll(good, neg)
+                    oneside += np.roll(sign, neg)
+                border &= np.abs(oneside) == BORDER_MIN_COUNT
+                border[0] = False
+                # and so are the BORDER_MIN_COUNT-1 tiles before a border
+                dilated = border.copy()
+                for neg in range(1,BORDER_MIN_COUNT):
+                    dilated |= np.roll(border, -neg)
+                borders.append(dilated)
                 
             # Creating borders for printing
             pos = 0
@@ -1454,8 +1627,8 @@ class CarRacing(gym.Env, EzPickle):
                 track  = self.tracks[j]
                 border = borders[j]
                 for i in range(len(track)):
-                    alpha1, beta1, x1, y1 = track[i][1]
-                    alpha2, beta2, x2, y2 = track[i][0]
+                    alpha1, beta1, x1, y1 = track[i,1]
+                    alpha2, beta2, x2, y2 = track[i,0]
                     if border[i]:
                         side = np.sign(beta2 - beta1)
 
@@ -1466,19 +1639,37 @@ class CarRacing(gym.Env, EzPickle):
                             if side == -1 and self.info[pos]['lanes'][0] == False: c = 0
                             if side == +1 and self.info[pos]['lanes'][1] == False: c = 0
 
-                        b1_l = (x1 + side* TRACK_WIDTH*c        *math.cos(beta1), y1 + side* TRACK_WIDTH*c        *math.sin(beta1))
-                        b1_r = (x1 + side*(TRACK_WIDTH*c+BORDER)*math.cos(beta1), y1 + side*(TRACK_WIDTH*c+BORDER)*math.sin(beta1))
-                        b2_l = (x2 + side* TRACK_WIDTH*c        *math.cos(beta2), y2 + side* TRACK_WIDTH*c        *math.sin(beta2))
-                        b2_r = (x2 + side*(TRACK_WIDTH*c+BORDER)*math.cos(beta2), y2 + side*(TRACK_WIDTH*c+BORDER)*math.sin(beta2))
+                        b1_l = (x1 + side* TRACK_WIDTH*c        *cos1[pos], y1 + side* TRACK_WIDTH*c        *sin1[pos])
+                        b1_r = (x1 + side*(TRACK_WIDTH*c+BORDER)*cos1[pos], y1 + side*(TRACK_WIDTH*c+BORDER)*sin1[pos])
+                        b2_l = (x2 + side* TRACK_WIDTH*c        *cos2[pos], y2 + side* TRACK_WIDTH*c        *sin2[pos])
+                        b2_r = (x2 + side*(TRACK_WIDTH*c+BORDER)*cos2[pos], y2 + side*(TRACK_WIDTH*c+BORDER)*sin2[pos])
                         self.border_poly.append(( [b1_l, b1_r, b2_r, b2_l], (1,1,1) if i%2==0 else (1,0,0) ))
                     pos += 1
 
 
+        # First and last position of each track in info, used to
+        # get the neighbours of a tile without scanning info every time
+        track_ids = self.info['track']
+        first_idx = np.zeros(len(self.tracks), dtype=int)
+        last_idx  = np.zeros(len(self.tracks), dtype=int)
+        for k in range(len(self.tracks)):
+            idxs = np.flatnonzero(track_ids == k)
+            first_idx[k] = idxs[0]
+            last_idx[k]  = idxs[-1]
+
+        # One static body per track with a sensor fixture for each tile,
+        # the information of the tile is in the userData of its fixture
+        track_bodies = [self.world.CreateStaticBody() for _ in range(len(self.tracks))]
+        self.road.extend(track_bodies)
+
+        # At most one polygon per lane of each tile
+        self._init_road_poly(len(self.track)*self.num_lanes)
+
         # Create tiles
         for j in range(len(self.track)):
-            obstacle = np.random.binomial(1,0)
-            alpha1, beta1, x1, y1 = self.track[j][1]
-            alpha2, beta2, x2, y2 = self.track[j][0]
+            track_id = track_ids[j]
+            alpha1, beta1, x1, y1 = self.track[j,1]
+            alpha2, beta2, x2, y2 = self.track[j,0]
             
             # drawing angles of old config, the 
             # black line is the angle (NOT WORKING)
@@ -1514,22 +1705,20 @@ class CarRacing(gym.Env, EzPickle):
 
                         # Getting if first tile of lane
                         # if last tile was from the same lane
-                        info_track = self.info[self.info['track'] == self.info[j]['track']]
-                        j_relative = j - sum(self.info['track'] < self.info[j]['track'])
-                        
-                        if info_track[j_relative-1]['track'] == info_track[j_relative]['track']:
-                            # If last tile didnt exist
-                            if info_track[j_relative-1]['lanes'][lane] == False:
-                                first = True
-                        if info_track[(j_relative+1)%len(info_track)]['track'] == info_track[j_relative]['track']:
-                            # If last tile didnt exist
-                            if info_track[(j_relative+1)%len(info_track)]['lanes'][lane] == False:
-                                last = True
-
-                    road1_l = (x1 - (1-last) *l*TRACK_WIDTH*math.cos(beta1), y1 - (1-last) *l*TRACK_WIDTH*math.sin(beta1))
-                    road1_r = (x1 + (1-last) *r*TRACK_WIDTH*math.cos(beta1), y1 + (1-last) *r*TRACK_WIDTH*math.sin(beta1))
-                    road2_l = (x2 - (1-first)*l*TRACK_WIDTH*math.cos(beta2), y2 - (1-first)*l*TRACK_WIDTH*math.sin(beta2))
-                    road2_r = (x2 + (1-first)*r*TRACK_WIDTH*math.cos(beta2), y2 + (1-first)*r*TRACK_WIDTH*math.sin(beta2))
+                        prev_j = j-1 if j > first_idx[track_id] else last_idx[track_id]
+                        next_j = j+1 if j < last_idx[track_id]  else first_idx[track_id]
+
+                        # If last tile didnt exist
+                        if self.info[prev_j]['lanes'][lane] == False:
+                            first = True
+                        # If next tile didnt exist
+                        if self.info[next_j]['lanes'][lane] == False:
+                            last = True
+
+                    road1_l = (x1 - (1-last) *l*TRACK_WIDTH*cos1[j], y1 - (1-last) *l*TRACK_WIDTH*sin1[j])
+                    road1_r = (x1 + (1-last) *r*TRACK_WIDTH*cos1[j], y1 + (1-last) *r*TRACK_WIDTH*sin1[j])
+                    road2_l = (x2 - (1-first)*l*TRACK_WIDTH*cos2[j], y2 - (1-first)*l*TRACK_WIDTH*sin2[j])
+                    road2_r = (x2 + (1-first)*r*TRACK_WIDTH*cos2[j], y2 + (1-first)*r*TRACK_WIDTH*sin2[j])
 
                     vertices = [road1_l, road1_r, road2_r, road2_l]
 
@@ -1550,21 +1739,24 @@ class CarRacing(gym.Env, EzPickle):
                                 p2 = road2_l if i == 0 else road2_r
 
                             if len(p3) == 0:
-                                max_idx = sum(sum(self.info[self.info['track'] == 0]['lanes'],[])) # this will work because only seconday tracks have ends
-                                p3_org = sum([x[0] for x in self.road_poly[:max_idx]],[])
+                                max_idx = self.info[self.info['track'] == 0]['lanes'].sum() # this will work because only seconday tracks have ends
+                                p3_org = self.road_poly_verts[:max_idx].reshape(-1,2)
                                 # filter p3 by distance to p1 < TRACK_WIDTH*2
+                                # (squared distances, computed once)
+                                diff = p3_org - p1
+                                d2 = np.einsum('ij,ij->i', diff, diff)
                                 distance = TRACK_WIDTH*2
-                                not_too_close = np.where(np.linalg.norm(np.subtract(p3_org,p1),axis=1) >= TRACK_WIDTH/3)[0]
+                                not_too_close = d2 >= np.square(TRACK_WIDTH/3)
                                 while len(p3) == 0 and distance < PLAYFIELD:
-                                    close = np.where(np.linalg.norm(np.subtract(p3_org,p1),axis=1) <= distance)[0]
-                                    p3 = [p3_org[i] for i in np.intersect1d(close,not_too_close)]
+                                    close = d2 <= distance*distance
+                                    p3 = p3_org[close & not_too_close]
                                     distance += TRACK_WIDTH
 
                             if len(p3) == 0:
                                 raise RuntimeError('p3 lenght is zero')
 
-                            d = (np.cross(np.subtract(p2,p1),np.subtract(p1,p3)))**2/np.linalg.norm(np.subtract(p2,p1))
-                            points.append(p3[d.argmin()])
+                            d = np.square(np.cross(np.subtract(p2,p1),np.subtract(p1,p3)))/np.linalg.norm(np.subtract(p2,p1))
+                            points.append(tuple(p3[d.argmin()]))
 
                         if self.info[j]['start']:
                             vertices = [points[0], points[1], road1_r, road1_l]
@@ -1578,7 +1770,7 @@ class CarRacing(gym.Env, EzPickle):
                         # TODO remove this try and find a way of really catching the errer
                         #try:
                         self.fd_tile.shape.vertices = vertices
-                        t = self.world.CreateStaticBody(fixtures=self.fd_tile)
+                        t = track_bodies[track_id].CreateFixture(self.fd_tile)
                         #except AssertionError as e:
                             #print(str(e))
                             #print(vertices)
@@ -1597,9 +1789,15 @@ class CarRacing(gym.Env, EzPickle):
                         t.road_friction = 1.0
                         t.id = j
                         t.lane = lane
-                        t.fixtures[0].sensor = True
-                        self.road_poly.append(( vertices, t.color, t.id, t.lane ))
-                        self.road.append(t)
+                        t.sensor = True
+                        k = self.road_poly_count
+                        self.road_poly_verts[k]  = vertices
+                        self.road_poly_colors[k] = t.color
+                        self.road_poly_ids[k]    = t.id
+                        self.road_poly_lanes[k]  = t.lane
+                        self.road_poly_count    += 1
+                        # the color is changed on contact, keep it pointing to the buffer
+                        t.color = self.road_poly_colors[k]
                     else:
                         print("saved from error")
 
@@ -1608,8 +1806,34 @@ class CarRacing(gym.Env, EzPickle):
         self.obstacle_contacts = np.zeros((len(self.obstacles_poly)),dtype=
                 [('count',int),('count_delay',int),('visited',bool)])
 
+        # Reward for visiting a tile, computed once per track
+        self._reward_per_tile = 1000.0/len(self.track)
+
+        self._set_debug_points()
+
         return True
 
+    def _set_debug_points(self):
+        '''
+        Keeps the [x,y] points marked by render_debug_clues, they only
+        change when a new track is created
+        '''
+        points = self.track[:,1,2:]
+        self._debug_points = {
+                'end':          points[self.info['end']],
+                'start':        points[self.info['start']],
+                'intersection': points[self.info['intersection']],
+                't':            points[self.info['t']],
+                'x':            points[self.info['x']],
+                'turns':        points[np.abs(self.info['angle']).argsort()[-10:]],
+                }
+        ids = set(self.info['intersection_id'])
+        ids.discard(-1)
+        # A color per group, without reseeding the global np.random
+        self._debug_groups = [
+                (points[self.info['intersection_id'] == id], np.random.RandomState(id).uniform(size=3))
+                for id in ids]
+
     def reset(self):
         '''
         car_position [angle float, x float, y float]
@@ -1626,7 +1850,7 @@ class CarRacing(gym.Env, EzPickle):
         self.t = 0.0
         self._current_nodes = {}
         self._next_nodes = []
-        self.road_poly = []
+        self._init_road_poly(0)
         self.border_poly = []
         self.obstacles_poly = []
         self.track = []
@@ -1694,6 +1918,9 @@ class CarRacing(gym.Env, EzPickle):
             self.car.gas(action[1])
             self.car.brake(action[2])
 
+        # Physics and rendering are kept sequential on purpose, the state
+        # has to show the world after this step and the contact callbacks
+        # of world.Step change info and the colors of tiles used to render
         self.car.step(1.0/FPS)
         self.world.Step(1.0/FPS, 6*30, 2*30)
         self.t += 1.0/FPS
@@ -1729,6 +1956,7 @@ class CarRacing(gym.Env, EzPickle):
         if self.viewer is None:
             from gym.envs.classic_control import rendering
             self.viewer = rendering.Viewer(WINDOW_W, WINDOW_H)
+            self._drop_gl_batches()
             self.score_label = pyglet.text.Label('Score: 0000', font_size=20,
                 x=20, y=WINDOW_H*1.5/40.00, anchor_x='left', anchor_y='center',
                 color=(255,255,255,255))
@@ -1754,10 +1982,10 @@ class CarRacing(gym.Env, EzPickle):
 
         zoom_state  = ZOOM*SCALE*STATE_W/WINDOW_W
         zoom_video  = ZOOM*SCALE*VIDEO_W/WINDOW_W
-        scroll_x = self.car.hull.position[0]
-        scroll_y = self.car.hull.position[1]
-        angle = -self.car.hull.angle
-        vel = self.car.hull.linearVelocity
+        hull = self.car.hull
+        scroll_x, scroll_y = hull.position
+        angle = -hull.angle
+        vel = hull.linearVelocity
         # The angle is the same as the car, not as the speed
         #if np.linalg.norm(vel) > 0.5:
         #    angle = math.atan2(vel[0], vel[1])
@@ -1766,9 +1994,11 @@ class CarRacing(gym.Env, EzPickle):
             self.transform.set_translation(WINDOW_W/2, WINDOW_H/2)
             self.transform.set_rotation(0) 
         else:
+            cos_a = math.cos(angle)
+            sin_a = math.sin(angle)
             self.transform.set_translation(
-                WINDOW_W/2 - (scroll_x*zoom*math.cos(angle) - scroll_y*zoom*math.sin(angle)), 
-                WINDOW_H/4 - (scroll_x*zoom*math.sin(angle) + scroll_y*zoom*math.cos(angle)) )
+                WINDOW_W/2 - (scroll_x*zoom*cos_a - scroll_y*zoom*sin_a), 
+                WINDOW_H/4 - (scroll_x*zoom*sin_a + scroll_y*zoom*cos_a) )
             self.transform.set_rotation(angle)
 
         self.car.draw(self.viewer, mode!="state_pixels")
@@ -1800,13 +2030,12 @@ class CarRacing(gym.Env, EzPickle):
             if self.show_info_panel:
                 self.render_indicators(WINDOW_W, WINDOW_H)  # TODO: find why 2x needed, wtf
             self._render_additional_objects()
-            image_data = pyglet.image.get_buffer_manager().get_color_buffer().get_image_data()
-            arr = np.fromstring(image_data.data, dtype=np.uint8, sep='')
-            arr = arr.reshape(VP_H, VP_W, 4)
-            arr = arr[::-1, :, 0:3]
+            arr = self._read_pixels(VP_W, VP_H)
             if self.grayscale and mode !="rgb_array":
-                arr_bw = np.dot(arr[...,:3], [0.299, 0.587, 0.114])
-                arr = arr_bw
+                arr = np.dot(arr, [0.299, 0.587, 0.114])
+            else:
+                # The buffer is overwritten by the next frame
+                arr = arr.copy()
             
         if mode=="rgb_array" and not self.human_render: # agent can call or not call env.render() itself when recording video.
             win.flip()
@@ -1828,6 +2057,23 @@ class CarRacing(gym.Env, EzPickle):
         self.viewer.onetime_geoms = []
         return arr
 
+    def _read_pixels(self, width, height):
+        '''
+        Reads the RGB pixels of the back buffer into a buffer that is
+        reused between frames of the same size, returns a (height,width,3)
+        view of it with the rows from top to bottom
+        '''
+        buf = self._pixels_buffers.get((width, height))
+        if buf is None:
+            buf = np.empty((height, width, 3), dtype=np.uint8)
+            self._pixels_buffers[(width, height)] = buf
+        gl.glReadBuffer(gl.GL_BACK)
+        gl.glPushClientAttrib(gl.GL_CLIENT_PIXEL_STORE_BIT)
+        gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 1)
+        gl.glReadPixels(0, 0, width, height, gl.GL_RGB, gl.GL_UNSIGNED_BYTE, buf.ctypes.data)
+        gl.glPopClientAttrib()
+        return buf[::-1]
+
     def _key_press(self,k,mod):
         from pyglet.window import key
         if k == key.S: # S from Show
@@ -1875,36 +2121,39 @@ class CarRacing(gym.Env, EzPickle):
         if self.viewer is not None:
             self.viewer.close()
             self.viewer = None
+        self._drop_gl_batches()
+
+    def _drop_gl_batches(self):
+        '''
+        The buffers of the batches belong to the GL context of the viewer,
+        a new viewer does not share them, so they are built again the next
+        time they are drawn
+        '''
+        self._grid_batch = None
+        self._indicators_batch = None
+        self._road_batch = None
 
     def _remove_roads(self):
 
         if self.num_tracks > 1:
-            def _get_section(first,last,track):
-                sec = []
-                pos = 0
-                found = False
-                while 1:
-                    point = track[pos%track.shape[0],:,2:]
-                    if np.linalg.norm(point[1]-first) <= TRACK_WIDTH/2:
-                        found = True
-                    if found:
-                        sec.append(point)
-                        if np.linalg.norm(point[1]-last) <= TRACK_WIDTH/2:
-                            break
-                    pos = pos+1
-                    if pos / track.shape[0] >= 2: break
-                if sec == []: return False
-                return np.array(sec)
+            def _get_section(first,last,points):
+                start, end = _find_section(points, first, last, (TRACK_WIDTH/2)**2)
+                if start == -1: return False
+                return points[np.arange(start, end) % len(points)]
 
             THRESHOLD = TRACK_WIDTH*2
 
             track1 = np.array(self.tracks[0])
             track2 = np.array(self.tracks[1])
 
-            points1 = track1[:,:,[2,3]]
-            points2 = track2[:,:,[2,3]]
+            # Contiguous copies of the [x,y] points, they are read by the jitted helpers
+            points1 = np.ascontiguousarray(track1[:,:,2:4])
+            points2 = np.ascontiguousarray(track2[:,:,2:4])
 
-            inter2 = np.array([x for x in points2 if (np.linalg.norm(points1[:,1,:]-x[1:], axis=1) <= TRACK_WIDTH/3.5 ).sum() >= 1])
+            # Points of the second track close to any point of the first one,
+            # all the squared distances between them at once (|points2|,|points1|)
+            d2 = _sq_distances(points2[:,1], points1[:,1])
+            inter2 = points2[(d2 <= (TRACK_WIDTH/3.5)**2).any(axis=1)]
 
             intersections = []
             for i in range(inter2.shape[0]):
@@ -1918,7 +2167,7 @@ class CarRacing(gym.Env, EzPickle):
             # > > get min distance
             # > get max of distances
             # if max dist < threshold remove
-            removed_idx = set()
+            keep = np.ones(len(track2), dtype=bool)
             intersection_keys = []
             intersection_vals = []
             sec1_closer_to_center = None
@@ -1926,8 +2175,8 @@ class CarRacing(gym.Env, EzPickle):
                 _, first = intersections[i-1]
                 last,_ = intersections[i]
 
-                sec1 = _get_section(first,last,track1)
-                sec2 = _get_section(first,last,track2)
+                sec1 = _get_section(first,last,points1)
+                sec2 = _get_section(first,last,points2)
 
                 sec1_distance_to_center = np.mean(np.linalg.norm(sec1[2:],axis=1))
                 sec2_distance_to_center = np.mean(np.linalg.norm(sec2[2:],axis=1))
@@ -1949,51 +2198,44 @@ class CarRacing(gym.Env, EzPickle):
                             sec1_closer_to_center = True
 
                     if remove is False:
-                        max_min_d = 0
                         remove = False
-                        min_distances = []
-                        for point in sec1[:,1]:
-                            dist = np.linalg.norm(sec2[:,1] - point, axis=1).min()
-                            min_distances.append(dist)
-                            #min_d = dist if max_min_d < dist else max_min_d
-
-                        min_distances = np.array(min_distances)
+                        # Squared distance from each point of sec1 to the closest
+                        # one of sec2, compared against squared thresholds
+                        min_distances = _sq_distances(sec1[:,1], sec2[:,1]).min(axis=1)
 
                         # if the max minimal distance is too small
-                        if min_distances.max() < THRESHOLD*2: remove = True
+                        if min_distances.max() < (THRESHOLD*2)**2: remove = True
                         # if the middle tiles of segment are too close to main track
-                        elif len(min_distances) > 25 and (min_distances[10:-10].min() < TRACK_WIDTH*3): 
+                        elif len(min_distances) > 25 and (min_distances[10:-10].min() < (TRACK_WIDTH*3)**2): 
                             remove = True
                         # if the segment is smaller than MIN_SEGMENT_LENGHT
                         elif len(min_distances) < MIN_SEGMENT_LENGHT: 
                             remove = True
                         # if there are more than 50 tiles very close to main track
-                        elif len(min_distances) > 50 and (min_distances < TRACK_WIDTH*2).sum() > 50: 
+                        elif len(min_distances) > 50 and (min_distances < (TRACK_WIDTH*2)**2).sum() > 50: 
                             remove = True
 
                     # Removing tiles
                     if remove:
-                        for point in sec2:
-                            idx = np.all(track2[:,:,[2,3]] == point, axis=(1,2))
-                            removed_idx.update(np.where(idx)[0])
+                        keep &= _prune_tiles(points2, sec2)
                     else:
                         key = np.where(
-                                np.all(track1[:,:,[2,3]] == sec1[0], axis=(1,2)))[0]
+                                np.all(points1 == sec1[0], axis=(1,2)))[0]
                         val = np.where(
-                                np.all(track2[:,:,[2,3]] == sec2[0], axis=(1,2)))[0]\
+                                np.all(points2 == sec2[0], axis=(1,2)))[0]\
                                         + len(track1)
                         intersection_keys.append(key[0])
                         intersection_vals.append(val[0])
 
                         key = np.where(
-                                np.all(track1[:,:,[2,3]] == sec1[-1], axis=(1,2)))[0]
+                                np.all(points1 == sec1[-1], axis=(1,2)))[0]
                         val = np.where(
-                                np.all(track2[:,:,[2,3]] == sec2[-1], axis=(1,2)))[0]\
+                                np.all(points2 == sec2[-1], axis=(1,2)))[0]\
                                         + len(track1)
                         intersection_keys.append(key[0])
                         intersection_vals.append(val[0])
 
-            track2 = np.delete(track2, list(removed_idx), axis=0) # efficient way to delete them from np.array
+            track2 = track2[keep]
 
             self.intersections = intersections
             
@@ -2007,177 +2249,223 @@ class CarRacing(gym.Env, EzPickle):
 
     def _render_tiles(self):
         '''
-        Can only be called inside a glBegin
+        Draws the tiles with the color of the ones in the trail of
+        predicted tiles halved.
+        Can not be called inside a glBegin
         '''
-        # drawing road old way
-        for poly, color, id, lane in self.road_poly:
-            if SHOW_NEXT_N_TILES > 0 and id in self._trail_nodes and lane in self._trail_nodes[id]:
+        n = self.road_poly_count
+        colors = self.road_poly_colors[:n]
+        if self._trail_nodes:
+            trail = [id in self._trail_nodes and lane in self._trail_nodes[id]
+                    for id, lane in zip(self.road_poly_ids[:n].tolist(),
+                                        self.road_poly_lanes[:n].tolist())]
             #if (hasattr(self,'_objective') and self._objective == id) or id in self._current_nodes.keys() \
             #or (hasattr(self,'_neg_objectives') and id in self._neg_objectives):
             #if id in self.predictions_id:
-                color = [c/2 for c in color]
-
-            gl.glColor4f(color[0], color[1], color[2], 1)
-            for p in poly:
-                gl.glVertex3f(p[0], p[1], 0)
+            colors = self._road_poly_trail_colors[:n]
+            np.copyto(colors, self.road_poly_colors[:n])
+            colors[np.array(trail, dtype=bool)] /= 2
+        self._render_tiles_batch(colors)
 
-    def _render_obstacles(self):
+    def _render_tiles_batch(self, colors=None):
+        '''
+        Draws the tiles with a single vertex list and the obstacles on
+        top of them, the batch is built the first time the tiles are
+        drawn after creating a track and the colors of the tiles
+        (road_poly_colors by default) are only uploaded again if the
+        color of some tile changes.
+        Can not be called inside a glBegin
+        '''
+        n = self.road_poly_count
+        if n == 0: return
+        if colors is None:
+            colors = self.road_poly_colors[:n]
+        if self._road_batch is None:
+            self._road_batch = pyglet.graphics.Batch()
+            self._road_vertex_list = self._road_batch.add(4*n, gl.GL_QUADS, None,
+                ('v2f/static', self.road_poly_verts[:n].ravel().tolist()),
+                ('c3f/dynamic', np.repeat(colors, 4, axis=0).ravel().tolist()))
+            self._road_batch_colors = colors.copy()
+            # same formats as the tiles, so they share the draw call and
+            # the obstacles are drawn after them
+            m = len(self.obstacles_poly)
+            if m > 0:
+                self._road_batch.add(4*m, gl.GL_QUADS, None,
+                    ('v2f/static', np.array([poly for poly, _ in self.obstacles_poly]).ravel().tolist()),
+                    ('c3f/dynamic', np.repeat([color[:3] for _, color in self.obstacles_poly],
+                        4, axis=0).ravel().tolist()))
+        elif not np.array_equal(self._road_batch_colors, colors):
+            self._road_vertex_list.colors = \
+                    np.repeat(colors, 4, axis=0).ravel().tolist()
+            self._road_batch_colors[:] = colors
+        self._road_batch.draw()
+
+    def _add_quads(self, quads, color):
         '''
-        Can only be called inside a glBegin
+        Adds the (N,4,2) quads with an rgba color, one for all of them
+        or (N,4), to the ones drawn by the next _draw_quads
         '''
-        # drawing road old way
-        for poly, color in self.obstacles_poly:
-            gl.glColor4f(color[0], color[1], color[2], 1)
-            for p in poly:
-                gl.glVertex3f(p[0], p[1], 0)
+        n = len(quads)
+        if n == 0: return
+        start = self._quads_count
+        end   = start + n
+        if end > len(self._quads_verts):
+            size = max(end, 2*len(self._quads_verts))
+            verts  = np.empty((size,4,2))
+            colors = np.empty((size,4))
+            verts[:start]  = self._quads_verts[:start]
+            colors[:start] = self._quads_colors[:start]
+            self._quads_verts, self._quads_colors = verts, colors
+        self._quads_verts[start:end]  = quads
+        self._quads_colors[start:end] = color
+        self._quads_count = end
+
+    def _draw_quads(self):
+        '''
+        Draws all the added quads with a single call and empties the buffers.
+        Can not be called inside a glBegin
+        '''
+        n = self._quads_count
+        if n == 0: return
+        pyglet.graphics.draw(4*n, gl.GL_QUADS,
+            ('v2f', self._quads_verts[:n].ravel().tolist()),
+            ('c4f', np.repeat(self._quads_colors[:n], 4, axis=0).ravel().tolist()))
+        self._quads_count = 0
+
+    def _render_grid(self):
+        '''
+        Draws the grass and its checkerboard with a batch built the
+        first time it is drawn.
+        Can not be called inside a glBegin
+        '''
+        if self._grid_batch is None:
+            k = PLAYFIELD/20.0
+            x, y = np.meshgrid(np.arange(-20, 20, 2), np.arange(-20, 20, 2), indexing='ij')
+            corners = np.stack([x, y], axis=-1).reshape(-1,1,2) + [[1,0],[0,0],[0,1],[1,1]]
+            verts = k*corners
+            self._grid_batch = pyglet.graphics.Batch()
+            # the background goes first, both share the draw call
+            self._grid_batch.add(4, gl.GL_QUADS, None,
+                ('v2f/static', [-PLAYFIELD, +PLAYFIELD, +PLAYFIELD, +PLAYFIELD,
+                                +PLAYFIELD, -PLAYFIELD, -PLAYFIELD, -PLAYFIELD]),
+                ('c3f/static', [0.4, 0.8, 0.4]*4))
+            self._grid_batch.add(verts.shape[0]*4, gl.GL_QUADS, None,
+                ('v2f/static', verts.ravel().tolist()),
+                ('c3f/static', [0.4, 0.9, 0.4]*(verts.shape[0]*4)))
+        self._grid_batch.draw()
 
     def render_road(self):
-        gl.glBegin(gl.GL_QUADS)
-        gl.glColor4f(0.4, 0.8, 0.4, 1.0)
-        gl.glVertex3f(-PLAYFIELD, +PLAYFIELD, 0)
-        gl.glVertex3f(+PLAYFIELD, +PLAYFIELD, 0)
-        gl.glVertex3f(+PLAYFIELD, -PLAYFIELD, 0)
-        gl.glVertex3f(-PLAYFIELD, -PLAYFIELD, 0)
-        gl.glColor4f(0.4, 0.9, 0.4, 1.0)
-        k = PLAYFIELD/20.0
-        for x in range(-20, 20, 2):
-            for y in range(-20, 20, 2):
-                gl.glVertex3f(k*x + k, k*y + 0, 0)
-                gl.glVertex3f(k*x + 0, k*y + 0, 0)
-                gl.glVertex3f(k*x + 0, k*y + k, 0)
-                gl.glVertex3f(k*x + k, k*y + k, 0)
+        '''
+        Draws from the grass up, the grass and the road have their own
+        batches and the debug quads of each layer are drawn together
+        with _draw_quads
+        '''
+        self._render_grid()
 
         # Ploting axis
         if SHOW_AXIS:
-            # x-axis
-            gl.glColor4f(0, 0, 0, 1)
-            gl.glVertex3f(-PLAYFIELD, 2, 0)
-            gl.glVertex3f(+PLAYFIELD, 2, 0)
-            gl.glVertex3f(+PLAYFIELD,-2, 0)
-            gl.glVertex3f(-PLAYFIELD,-2, 0)
-            
-            # y-axis
-            gl.glVertex3f(+2,-PLAYFIELD, 0)
-            gl.glVertex3f(+2,+PLAYFIELD, 0)
-            gl.glVertex3f(-2,+PLAYFIELD, 0)
-            gl.glVertex3f(-2,-PLAYFIELD, 0)
+            self._add_quads(np.array([
+                # x-axis
+                [[-PLAYFIELD, 2], [+PLAYFIELD, 2], [+PLAYFIELD,-2], [-PLAYFIELD,-2]],
+                # y-axis
+                [[+2,-PLAYFIELD], [+2,+PLAYFIELD], [-2,+PLAYFIELD], [-2,-PLAYFIELD]]]),
+                (0, 0, 0, 1))
+            self._draw_quads()
 
         self._update_predictions()
-        self._render_tiles()
-        self._render_obstacles()
+        if SHOW_NEXT_N_TILES > 0:
+            # the colors of the predicted tiles change every frame
+            self._render_tiles()
+        else:
+            self._render_tiles_batch()
         self._render_road_lines()
         self.render_debug_clues()
-
-        gl.glEnd()
+        self._draw_quads()
 
     def _render_road_lines(self):
-        if SHOW_BETA_PI_ANGLE:
-            for block in self.track_lanes:
-                gl.glColor4f(1, 1, 1, 0.8)
-                for x,y in block:
-                    gl.glVertex3f(x,y,0)
+        if SHOW_BETA_PI_ANGLE and self.track_lanes:
+            self._add_quads(np.array(self.track_lanes), (1, 1, 1, 0.8))
+
+    def _render_debug_quads(self, points, size, color):
+        '''
+        Adds a square of side 2*size with the given rgb color centered
+        in each of the (N,2) points
+        '''
+        quads = points[:,None,:] + size*np.array([[1,1],[-1,1],[-1,-1],[1,-1]])
+        self._add_quads(quads, (color[0], color[1], color[2], 1))
 
     def render_debug_clues(self):
+        points = self._debug_points
 
         if SHOW_ENDS_OF_TRACKS:
-            for x,y in self.track[self.info['end']][:,1,2:]:
-                gl.glColor4f(1, 0, 0, 1)
-                gl.glVertex3f(x+2,y+2,0)
-                gl.glVertex3f(x-2,y+2,0)
-                gl.glVertex3f(x-2,y-2,0)
-                gl.glVertex3f(x+2,y-2,0)
+            self._render_debug_quads(points['end'], 2, (1,0,0))
 
         if SHOW_START_OF_TRACKS:
-            for x,y in self.track[self.info['start']][:,1,2:]:
-                gl.glColor4f(0, 1, 0, 1)
-                gl.glVertex3f(x+2,y+2,0)
-                gl.glVertex3f(x-2,y+2,0)
-                gl.glVertex3f(x-2,y-2,0)
-                gl.glVertex3f(x+2,y-2,0)
+            self._render_debug_quads(points['start'], 2, (0,1,0))
 
         if SHOW_INTERSECTION_POINTS:
-            for x,y in self.track[self.info['intersection']][:,1,2:]:
-                gl.glColor4f(1, 1, 0, 1)
-                gl.glVertex3f(x+1,y+1,0)
-                gl.glVertex3f(x-1,y+1,0)
-                gl.glVertex3f(x-1,y-1,0)
-                gl.glVertex3f(x+1,y-1,0)
+            self._render_debug_quads(points['intersection'], 1, (1,1,0))
 
         if SHOW_GROUP_INTERSECTIONS:
-            ids = set(self.info['intersection_id'])
-            ids.remove(-1)
-
-            for id in ids:
-                np.random.seed(id)
-                r = np.random.uniform(size=3)
-                for elem in self.track[self.info['intersection_id'] == id]:
-                    x,y = elem[1,2:]
-                    gl.glColor4f(r[0], r[1], r[2], 1)
-                    gl.glVertex3f(x+1,y+1,0)
-                    gl.glVertex3f(x-1,y+1,0)
-                    gl.glVertex3f(x-1,y-1,0)
-                    gl.glVertex3f(x+1,y-1,0)
+            for group, color in self._debug_groups:
+                self._render_debug_quads(group, 1, color)
             
         if SHOW_XT_JUNCTIONS:
-            for x,y in self.track[self.info['t']][:,1,2:]:
-                gl.glColor4f(0, 0.4, 0, 1)
-                gl.glVertex3f(x+1,y+1,0)
-                gl.glVertex3f(x-1,y+1,0)
-                gl.glVertex3f(x-1,y-1,0)
-                gl.glVertex3f(x+1,y-1,0)
-            for x,y in self.track[self.info['x']][:,1,2:]:
-                gl.glColor4f(6, 0.8, 0.18, 1)
-                gl.glVertex3f(x+1,y+1,0)
-                gl.glVertex3f(x-1,y+1,0)
-                gl.glVertex3f(x-1,y-1,0)
-                gl.glVertex3f(x+1,y-1,0)
+            self._render_debug_quads(points['t'], 1, (0,0.4,0))
+            self._render_debug_quads(points['x'], 1, (6,0.8,0.18))
 
         if SHOW_TURNS:
-            for x,y in self.track[np.abs(self.info['angle']).argsort()[-10:]][:,1,2:]:
-                gl.glColor4f(1, 0, 0, 1)
-                gl.glVertex3f(x+1,y+1,0)
-                gl.glVertex3f(x-1,y+1,0)
-                gl.glVertex3f(x-1,y-1,0)
-                gl.glVertex3f(x+1,y-1,0)
+            self._render_debug_quads(points['turns'], 1, (1,0,0))
 
     def render_indicators(self, W, H):
-        gl.glBegin(gl.GL_QUADS)
+        '''
+        Draws the black background and the bars of the indicators with a
+        single vertex list, only its vertices are uploaded every frame
+        '''
         s = W/40.0
         h = H/40.0
-        gl.glColor4f(0,0,0,1)
-        gl.glVertex3f(W, 0, 0)
-        gl.glVertex3f(W, 5*h, 0)
-        gl.glVertex3f(0, 5*h, 0)
-        gl.glVertex3f(0, 0, 0)
-        def vertical_ind(place, val, color):
-            gl.glColor4f(color[0], color[1], color[2], 1)
-            gl.glVertex3f((place+0)*s, h + h*val, 0)
-            gl.glVertex3f((place+1)*s, h + h*val, 0)
-            gl.glVertex3f((place+1)*s, h, 0)
-            gl.glVertex3f((place+0)*s, h, 0)
-        def horiz_ind(place, val, color):
-            gl.glColor4f(color[0], color[1], color[2], 1)
-            gl.glVertex3f((place+0)*s, 4*h , 0)
-            gl.glVertex3f((place+val)*s, 4*h, 0)
-            gl.glVertex3f((place+val)*s, 2*h, 0)
-            gl.glVertex3f((place+0)*s, 2*h, 0)
-        true_speed = np.sqrt(np.square(self.car.hull.linearVelocity[0]) + np.square(self.car.hull.linearVelocity[1]))
-        vertical_ind(21, 0.02*true_speed, (1,1,1))
-        vertical_ind(22, 0.01*self.car.wheels[0].omega, (0.0,0,1)) # ABS sensors
-        vertical_ind(23, 0.01*self.car.wheels[1].omega, (0.0,0,1))
-        vertical_ind(24, 0.01*self.car.wheels[2].omega, (0.2,0,1))
-        vertical_ind(25,0.01*self.car.wheels[3].omega, (0.2,0,1))
-        horiz_ind(30, -5.0*self.car.wheels[0].joint.angle, (0,1,0))
-        horiz_ind(36, -0.4*self.car.hull.angularVelocity, (1,0,0))
-        gl.glEnd()
-        self.score_label.text = "Score: %04i" % self.reward
-        self.full_score_label.text = "Full Score: %04i" % self.full_reward
-        self.speed_label.text = "Speed: %0.2f" % np.linalg.norm(self.car.hull.linearVelocity)
-        self.angle_label.text = "Angle: %0.2f" % self.car.wheels[0].joint.angle
-        self.score_label.draw()
-        self.full_score_label.draw()
-        self.speed_label.draw()
-        self.angle_label.draw()
+        vx, vy = self.car.hull.linearVelocity
+        true_speed = math.hypot(vx, vy)
+        wheels = self.car.wheels
+        vals = self._indicators_vals
+        vals[0] = 0.02*true_speed
+        for i, w in enumerate(wheels):
+            vals[1+i] = 0.01*w.omega
+        vals[5] = -5.0*wheels[0].joint.angle
+        vals[6] = -0.4*self.car.hull.angularVelocity
+
+        verts = self._indicators_verts
+        verts[0] = ((W, 0), (W, 5*h), (0, 5*h), (0, 0))
+        # vertical bars, the top grows with the value
+        np.multiply(INDICATORS_VERTICAL_X, s, out=verts[1:6,:,0])
+        y = verts[1:6,:,1]
+        np.multiply(vals[:5,None], INDICATORS_VERTICAL_UP, out=y)
+        y += 1
+        y *= h
+        # horizontal bars, the side grows with the value
+        x = verts[6:,:,0]
+        np.multiply(vals[5:,None], INDICATORS_HORIZ_SIDE, out=x)
+        x += INDICATORS_HORIZ_X
+        x *= s
+        np.multiply(INDICATORS_HORIZ_Y, h, out=verts[6:,:,1])
+
+        if self._indicators_batch is None:
+            colors = [(0,0,0), (1,1,1), (0,0,1), (0,0,1), (0.2,0,1), (0.2,0,1), (0,1,0), (1,0,0)]
+            self._indicators_batch = pyglet.graphics.Batch()
+            self._indicators_vertex_list = self._indicators_batch.add(32, gl.GL_QUADS, None,
+                'v2f/stream', ('c3f/static', np.repeat(colors, 4, axis=0).ravel().tolist()))
+        self._indicators_vertex_list.vertices = verts.ravel().tolist()
+        self._indicators_batch.draw()
+
+        # Setting the text of a label lays it out again, only do it when it changes
+        for label, text in (
+                (self.score_label,      "Score: %04i" % self.reward),
+                (self.full_score_label, "Full Score: %04i" % self.full_reward),
+                (self.speed_label,      "Speed: %0.2f" % true_speed),
+                (self.angle_label,      "Angle: %0.2f" % wheels[0].joint.angle)):
+            if label.text != text:
+                label.text = text
+            label.draw()
 
     def get_rnd_point_in_track(self,border=True):
         '''
@@ -2190,7 +2478,7 @@ class CarRacing(gym.Env, EzPickle):
         -----
         Returns: [beta, x, y]
         '''
-        direction = 1 if np.random.uniform() > 0.5 else -1
+        direction = 1 if self.np_random.uniform() > 0.5 else -1
         idx = self.np_random.randint(0, len(self.track))
         _,beta,x,y = self._get_rnd_position_inside_lane(
                 idx,border=border,direction=direction)
@@ -2203,8 +2491,7 @@ class CarRacing(gym.Env, EzPickle):
         discrete=True means the random position is either 0 or 1, i.e. in the
         beginning or the end of the position in the x-relative coordinate
         '''
-        h = np.random.uniform(0,1)
-        h = 1 if h >= 0.5 else 0
+        h = 1 if self.np_random.uniform() >= 0.5 else 0
         return self._get_position_inside_lane(
                 idx,h,border=border,direction=direction,discrete=discrete)
 
@@ -2213,9 +2500,13 @@ class CarRacing(gym.Env, EzPickle):
         x_pos in [0,1] meaning the position in the x axis relative to the direction
         '''
         alpha, beta, x, y = self.track[idx,1,:]
+        cos_beta = self._cos_beta[idx]
+        sin_beta = self._sin_beta[idx]
         if direction == -1:
             alpha+=np.pi
             beta+=np.pi
+            cos_beta = -cos_beta
+            sin_beta = -sin_beta
         from_val, to_val = self._get_extremes_of_position(idx,border)
         if discrete:
             # it is 1-border in becase -TRACK_WIDTH when border=True
@@ -2224,8 +2515,8 @@ class CarRacing(gym.Env, EzPickle):
             x_pos = from_val*x_pos + (1-x_pos)*(to_val-TRACK_WIDTH*(1-border))
         else:
             x_pos = from_val*x_pos + (1-x_pos)*to_val
-        x += x_pos*math.cos(beta)
-        y += x_pos*math.sin(beta)
+        x += x_pos*cos_beta
+        y += x_pos*sin_beta
         return [alpha,beta,x,y]
 
     def _get_extremes_of_position(self,idx,border):
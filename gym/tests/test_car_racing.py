@@ -1,3 +1,7 @@
+import pickle
+
+import numpy as np
+import pandas as pd
 import pytest
 from gym.envs.box2d.car_racing import CarRacing
 
@@ -32,6 +36,48 @@ class TestCarRacing(object):
         env.close()
         del env
 
+    def test_load_tracks_with_old_info(self,tmpdir):
+        env = CarRacing(num_tracks=2,num_lanes=2)
+        env.seed(0)
+        while env._generate_track() is False:
+            pass
+
+        # Before 'lanes' was a bool field it was an object field with lists
+        old_dtype = [(name,'O') if name == 'lanes' else (name,env.info.dtype[name])
+                for name in env.info.dtype.names]
+        old_info = np.zeros(len(env.info), dtype=old_dtype)
+        for name in env.info.dtype.names:
+            if name != 'lanes': old_info[name] = env.info[name]
+        for i in range(len(old_info)):
+            old_info[i]['lanes'] = [True, True]
+
+        with open(str(tmpdir.join("0.pkl")),'wb') as f:
+            pickle.dump({'track':env.track,'tracks':env.tracks,'info':old_info}, f)
+        pd.DataFrame(index=[0]).to_csv(str(tmpdir.join("list.csv")))
+
+        env = CarRacing(num_tracks=2,num_lanes=2,load_tracks_from=str(tmpdir))
+        env._init_road_poly(0)
+        env.border_poly = []
+        env.obstacles_poly = []
+        env.road = []
+        env.track_lanes = None
+        assert env._create_track()
+        assert env.info.dtype['lanes'].shape == (2,)
+        assert env.info['lanes'].all()
+        assert np.array_equal(env.info['track'], old_info['track'])
+
+    def test_render_after_close(self):
+        env = CarRacing()
+        env.reset()
+        env.render('state_pixels')
+        env.close()
+
+        # The batches of the closed viewer should not be drawn in a new one
+        frame = env.render('state_pixels')
+        assert frame.std() > 0
+
+        env.close()
+
     def test_screenshot(self,tmpdir):
         # TODO use tempdir to save screenshots
         pass
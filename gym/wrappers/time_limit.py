@@ -55,9 +55,9 @@ class TimeLimit(Wrapper):
         else:
             return NotImplementedError
 
-    def set_velocity(self, velocity):
+    def set_velocity(self, vx=0.0, vy=0.0):
         if self.unwrapped.spec.id.lower() == "carracing-v0":
-            return self.env.set_velocity(velocity)
+            return self.env.set_velocity(vx, vy)
         else:
             return NotImplementedError
 